@@ -1,20 +1,77 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import openai
 import anthropic
+import bleach
+import contextlib
+import functools
+import html
+import httpx
+import itertools
+import math
+import orjson
 import os
+import queue
+import random
 import sqlite3
 import sys
+import threading
 import time
 import logging
+import zstandard
+from markdown_it import MarkdownIt
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
-DB_NAME = 'chat_history.db'
+DB_NAME = os.environ.get('DB_NAME', 'chat_history.db')
+DB_READERS = max(1, int(os.environ.get("DB_READERS", "4")))
+READER_MMAP_SIZE = 256 * 1024 * 1024
+HISTORY_BATCH_SIZE = 100
+HISTORY_SQL = "SELECT question, answer, answer_z, timestamp FROM chat_history ORDER BY rowid"
+RENDER_CACHE_SIZE = 4096
+
+# New answers are stored zstd-compressed in answer_z; answer stays empty for them
+ANSWER_COMPRESSION_LEVEL = 3
+_INSERT_SQL = "INSERT INTO chat_history (question, answer, answer_z) VALUES (?, '', ?)"
+
+# One long-lived writer connection plus a small pool of read-only connections
+_writer = None
+_pool_lock = threading.Lock()
+_write_lock = threading.Lock()
+_readers = queue.Queue(maxsize=DB_READERS)
+
+# Tags an answer may keep when rendered in the chat history; everything else is stripped
+ALLOWED_TAGS = frozenset({
+    "b", "blockquote", "br", "code", "dd", "del", "div", "dl", "dt", "em",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "i", "ins", "kbd", "li", "mark",
+    "ol", "p", "pre", "s", "section", "small", "span", "strong", "sub", "sup",
+    "table", "tbody", "td", "tfoot", "th", "thead", "tr", "u", "ul",
+})
+
+# Answers mix Markdown with the HTML the prompt asks for, so raw HTML is passed through to bleach
+markdown = MarkdownIt("commonmark", {"html": True, "breaks": True}).enable(["table", "strikethrough"])
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify."""
+
+    def dumps(self, obj, **kwargs):
+        option = 0
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Key order in API responses doesn't matter, so skip sorting them
+app.json.sort_keys = False
 
 # API setup
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -24,61 +81,209 @@ class InsufficientCreditsError(RuntimeError):
     """Exception raised when the API account has insufficient credits."""
     pass
 
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` calls per `period` seconds."""
+
+    def __init__(self, rate, period=60.0):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token and return 0, or return the seconds until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.fill_rate
+
+# Attempts per question on rate-limit errors, and the longest backoff worth waiting for
+MAX_RETRIES = max(1, int(os.environ.get("MAX_RETRIES", "5")))
+MAX_RETRY_DELAY = 8
+# Backoff waits go through this name so tests can swap it without patching time.sleep for every thread
+sleep = time.sleep
+
+# Optional cap on questions per minute per process, applied before the provider is called (0 disables it)
+ASK_RATE_PER_MINUTE = int(os.environ.get("ASK_RATE_PER_MINUTE", "0"))
+_ask_limiter = TokenBucket(ASK_RATE_PER_MINUTE) if ASK_RATE_PER_MINUTE > 0 else None
+
 if not OPENAI_API_KEY and not CLAUDE_API_KEY:
     logger.error("Neither OPENAI_API_KEY nor CLAUDE_API_KEY environment variables are set")
     sys.exit(1)
 
-# Validate Claude API key if it's being used
-if CLAUDE_API_KEY and not OPENAI_API_KEY:
-    try:
-        claude_client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
-        # Test the API key with a minimal request
-        test_message = claude_client.messages.create(
-            model="claude-3-sonnet-20240229",
-            max_tokens=1,
-            messages=[{"role": "user", "content": "test"}]
-        )
-        print("Using Claude API - credentials verified")
-    except anthropic.BadRequestError as e:
-        if "credit balance is too low" in str(e):
-            logger.error("Claude API key is valid but account has insufficient credits")
-            raise InsufficientCreditsError("Claude API account has insufficient credits - please check your billing status")
-        else:
+# One keep-alive connection pool shared by the provider clients, so requests reuse TLS connections
+http_client = httpx.Client(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=300),
+)
+
+_credentials_verified = False
+_credentials_lock = threading.Lock()
+
+def verify_credentials():
+    global _credentials_verified
+    if _credentials_verified or OPENAI_API_KEY:
+        return
+    with _credentials_lock:
+        if _credentials_verified:
+            return
+        try:
+            # Test the API key with a minimal request
+            claude_client.messages.create(
+                model="claude-3-sonnet-20240229",
+                max_tokens=1,
+                messages=[{"role": "user", "content": "test"}]
+            )
+        except anthropic.BadRequestError as e:
+            if "credit balance is too low" in str(e):
+                logger.error("Claude API key is valid but account has insufficient credits")
+                raise InsufficientCreditsError("Claude API account has insufficient credits - please check your billing status")
             logger.error(f"Error validating Claude API key: {str(e)}")
             raise
-    except Exception as e:
-        logger.error(f"Error validating Claude API key: {str(e)}")
-        sys.exit(1)
-elif OPENAI_API_KEY:
-    openai.api_key = OPENAI_API_KEY
-    print("Using OpenAI API")
+        except Exception as e:
+            logger.error(f"Error validating Claude API key: {str(e)}")
+            raise
+        _credentials_verified = True
+        logger.info("Claude API credentials verified")
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+def _create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    answer_z BLOB,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+    # Databases created before answers were compressed lack the answer_z column
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(chat_history)")}
+    if "answer_z" not in columns:
+        conn.execute("ALTER TABLE chat_history ADD COLUMN answer_z BLOB")
+
+def get_writer():
+    global _writer
+    with _pool_lock:
+        if _writer is None:
+            conn = _connect()
+            _create_schema(conn)
+            _writer = conn
+        return _writer
+
+@contextlib.contextmanager
+def borrow_reader():
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        # Opening the writer first guarantees the schema exists before anything is read
+        get_writer()
+        conn = _connect()
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA mmap_size={READER_MMAP_SIZE}")
+    try:
+        yield conn
+    finally:
+        try:
+            _readers.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_connections():
+    global _writer
+    with _pool_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+    while True:
+        try:
+            _readers.get_nowait().close()
+        except queue.Empty:
+            break
 
 def create_table():
-    conn = sqlite3.connect(DB_NAME)
-    db_cursor = conn.cursor()
-    db_cursor.execute('''CREATE TABLE IF NOT EXISTS chat_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        question TEXT NOT NULL,
-                        answer TEXT NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )''')
-    conn.commit()
-    conn.close()
+    conn = get_writer()
+    with _write_lock:
+        _create_schema(conn)
+
+def _compress_answer(answer):
+    return zstandard.compress(answer.encode("utf-8"), ANSWER_COMPRESSION_LEVEL)
+
+def _stored_answer(answer, answer_z):
+    if answer_z is None:
+        return answer
+    return zstandard.decompress(answer_z).decode("utf-8")
 
 def insert_question_answer(question, answer):
-    conn = sqlite3.connect(DB_NAME)
-    db_cursor = conn.cursor()
-    try:
-        db_cursor.execute("INSERT INTO chat_history (question, answer) VALUES (?, ?)", (question, answer))
-    except sqlite3.OperationalError:
-        create_table()
-        db_cursor.execute("INSERT INTO chat_history (question, answer) VALUES (?, ?)", (question, answer))
-    conn.commit()
-    conn.close()
+    params = (question, _compress_answer(answer))
+    conn = get_writer()
+    with _write_lock, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(_INSERT_SQL, params)
+
+def insert_many(pairs):
+    rows = [(question, _compress_answer(answer)) for question, answer in pairs]
+    conn = get_writer()
+    with _write_lock, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(_INSERT_SQL, rows)
+
+# Characters that can start Markdown or HTML markup anywhere in a line
+_MARKUP_CHARS = frozenset('\\`*_[]<>&|~!"\t\r')
+
+def _plain_text_html(answer):
+    # Prose with no markup only gets wrapped in paragraphs, so the full pipeline can be skipped.
+    # Control characters are left to the pipeline, which replaces them.
+    if _MARKUP_CHARS.intersection(answer):
+        return None
+    paragraphs, lines = [], []
+    for line in answer.split("\n"):
+        if not line:
+            if lines:
+                paragraphs.append("<br>\n".join(lines))
+                lines = []
+        elif line[0].isalpha() and line == line.strip() and line.isprintable():
+            lines.append(line)
+        else:
+            return None
+    if lines:
+        paragraphs.append("<br>\n".join(lines))
+    return "".join(f"<p>{paragraph}</p>\n" for paragraph in paragraphs)
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render_answer_html(answer):
+    plain = _plain_text_html(answer)
+    if plain is not None:
+        return plain
+
+    # markdown-it handles **bold**; any "**" left after rendering is meant literally (code, escapes, a ** b)
+    return bleach.clean(markdown.render(answer), tags=ALLOWED_TAGS, attributes={}, strip=True)
+
+def warm_render_cache():
+    with borrow_reader() as conn:
+        records = conn.execute(
+            "SELECT answer, answer_z FROM chat_history ORDER BY id DESC LIMIT ?", (RENDER_CACHE_SIZE,)
+        ).fetchall()
+    # Render oldest first so the newest answers end up most recently used
+    for answer, answer_z in reversed(records):
+        _render_answer_html(_stored_answer(answer, answer_z))
+    logger.info("Warmed render cache with %d answers", len(records))
 
 def get_claude_response(question):
     try:
-        logger.info(f"Sending request to Claude API: {question}")
+        logger.debug("Sending request to Claude API: %s", question)
         message = claude_client.messages.create(
             model="claude-3-sonnet-20240229",
             messages=[{
@@ -87,7 +292,7 @@ def get_claude_response(question):
             }],
             max_tokens=1024
         )
-        logger.info("Received response from Claude API")
+        logger.debug("Received response from Claude API")
         return message.content[0].text
     except anthropic.BadRequestError as e:
         if "credit balance is too low" in str(e):
@@ -102,91 +307,235 @@ def get_claude_response(question):
 
 def get_openai_response(question):
     try:
-        logger.info(f"Sending request to OpenAI API: {question}")
-        response = openai.chat.completions.create(
+        logger.debug("Sending request to OpenAI API: %s", question)
+        response = openai_client.chat.completions.create(
             model="gpt-4-turbo-preview",
             messages=[
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": question}
             ],
         )
-        logger.info("Received response from OpenAI API")
+        logger.debug("Received response from OpenAI API")
         return response.choices[0].message.content
     except Exception as e:
         logger.error(f"Error in OpenAI API call: {str(e)}", exc_info=True)
         raise
 
-@app.route('/')
-def home():
+def stream_claude_response(question):
+    logger.debug("Streaming request to Claude API: %s", question)
+    with claude_client.messages.stream(
+        model="claude-3-sonnet-20240229",
+        messages=[{
+            "role": "user",
+            "content": question
+        }],
+        max_tokens=1024
+    ) as stream:
+        for text in stream.text_stream:
+            yield text
+    logger.debug("Finished streaming response from Claude API")
+
+def stream_openai_response(question):
+    logger.debug("Streaming request to OpenAI API: %s", question)
+    stream = openai_client.chat.completions.create(
+        model="gpt-4-turbo-preview",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": question}
+        ],
+        stream=True,
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+    logger.debug("Finished streaming response from OpenAI API")
+
+# The provider is resolved here, not on every request; OpenAI wins when both keys are given
+def configure(openai_key=None, claude_key=None):
+    global OPENAI_API_KEY, CLAUDE_API_KEY, openai_client, claude_client
+    global _credentials_verified, _TITLE, _ANSWER_FN, _STREAM_FN
+    OPENAI_API_KEY = openai_key
+    CLAUDE_API_KEY = claude_key
+    _credentials_verified = False
+
+    # Claude credentials are checked lazily by verify_credentials() rather than here
+    if CLAUDE_API_KEY and not OPENAI_API_KEY:
+        claude_client = anthropic.Anthropic(api_key=CLAUDE_API_KEY, http_client=http_client)
+        print("Using Claude API")
+    elif OPENAI_API_KEY:
+        openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+        print("Using OpenAI API")
+
     if OPENAI_API_KEY:
-        title = "Chat with ChatGPT"
+        _TITLE = "Chat with ChatGPT"
+        _ANSWER_FN = get_openai_response
+        _STREAM_FN = stream_openai_response
     elif CLAUDE_API_KEY:
-        title = "Chat with Claude"
+        _TITLE = "Chat with Claude"
+        _ANSWER_FN = get_claude_response
+        _STREAM_FN = stream_claude_response
     else:
-        title = "Chat with No Model Available"
+        _TITLE = "Chat with No Model Available"
+        _ANSWER_FN = _STREAM_FN = None
+
+# Call again after changing the API keys in the environment
+def reload_keys():
+    configure(os.getenv("OPENAI_API_KEY"), os.getenv("CLAUDE_API_KEY"))
+
+reload_keys()
+
+_HTML_SUFFIX = ". Answer the question using HTML5 tags to improve formatting. Do not break the 3rd wall and explicitly mention the HTML5 tags."
+
+def _html_prompt(question):
+    return question + _HTML_SUFFIX
 
-    return render_template('index.html', title=title)
+def _sse_event(data, event=None):
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+def _throttled_response():
+    if _ask_limiter is None:
+        return None
+    wait = _ask_limiter.try_acquire()
+    if not wait:
+        return None
+    logger.warning(f"Question rate limit reached, retry in {wait:.1f}s")
+    return jsonify(error="Too many questions, please try again later."), 429, {"Retry-After": str(math.ceil(wait))}
+
+def _retry_delay(error, attempt):
+    # Prefer the provider's Retry-After over our own backoff, unless it is negative, NaN or infinite
+    try:
+        delay = float(error.response.headers["retry-after"])
+        if math.isfinite(delay) and delay >= 0:
+            return delay
+    except (AttributeError, KeyError, TypeError, ValueError):
+        pass
+    return min(2 ** attempt + random.random(), MAX_RETRY_DELAY)
+
+@app.route('/')
+def home():
+    return render_template('index.html', title=_TITLE)
 
 @app.route('/ask', methods=['POST'])
 @app.route('/chat/ask', methods=['POST'])
 def ask():
     question = request.json['question']
-    logger.info(f"Received question: {question}")
-    actual_question = f"{question}. Answer the question using HTML5 tags to improve formatting. Do not break the 3rd wall and explicitly mention the HTML5 tags."
+    if not isinstance(question, str):
+        return jsonify(error="question must be a string"), 400
+    logger.debug("Received question: %s", question)
+    if _ANSWER_FN is None:
+        return jsonify(error="No model available"), 503
+    throttled = _throttled_response()
+    if throttled:
+        return throttled
+    actual_question = _html_prompt(question)
     
-    retries = 5
-    for i in range(retries):
+    for i in range(MAX_RETRIES):
         try:
-            if OPENAI_API_KEY:
-                answer = get_openai_response(actual_question)
-            else:
-                answer = get_claude_response(actual_question)
+            verify_credentials()
+            answer = _ANSWER_FN(actual_question)
+            # OpenAI returns content=None when the model gives no text, e.g. a refusal or tool call
+            if answer is None:
+                logger.error("API response had no answer text")
+                return jsonify(error="The model returned no answer"), 502
             
-            logger.info("API response received successfully")
+            logger.debug("API response received successfully")
+            # Saved before replying, since the page reloads the history as soon as the answer arrives
             insert_question_answer(question, answer)
             return jsonify(question=question, answer=answer)
             
         except (openai.RateLimitError, anthropic.RateLimitError) as e:
-            logger.warning("Rate limit error (attempt {}/{}): {}".format(i + 1, retries, str(e)))
-            if i < retries - 1:
-                time.sleep(10)
-            else:
-                return jsonify(error="API is overloaded, please try again later."), 503
+            logger.warning("Rate limit error (attempt {}/{}): {}".format(i + 1, MAX_RETRIES, str(e)))
+            delay = _retry_delay(e, i)
+            if i == MAX_RETRIES - 1 or delay > MAX_RETRY_DELAY:
+                return jsonify(error="API is overloaded, please try again later."), 503, {"Retry-After": str(math.ceil(delay))}
+            sleep(delay)
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
             return jsonify(error=str(e)), 500
 
-@app.route('/chat_history')
-@app.route('/chat/chat_history')
-def chat_history():
-    conn = sqlite3.connect(DB_NAME)
-    db_cursor = conn.cursor()
-    db_cursor.execute("SELECT question, answer, timestamp FROM chat_history ORDER BY id ASC")
-    records = db_cursor.fetchall()
-    conn.close()
+@app.route('/ask/stream', methods=['POST'])
+@app.route('/chat/ask/stream', methods=['POST'])
+def ask_stream():
+    question = request.json['question']
+    if not isinstance(question, str):
+        return jsonify(error="question must be a string"), 400
+    logger.debug("Received streamed question: %s", question)
+    if _STREAM_FN is None:
+        return jsonify(error="No model available"), 503
+    throttled = _throttled_response()
+    if throttled:
+        return throttled
+    actual_question = _html_prompt(question)
 
-    chat_history_html = "<html><body>"
+    def generate():
+        answer_parts = []
+        try:
+            verify_credentials()
+            for chunk in _STREAM_FN(actual_question):
+                answer_parts.append(chunk)
+                yield _sse_event(chunk)
+            # Saved before "done", so a history reload after it includes this answer
+            insert_question_answer(question, "".join(answer_parts))
+        except Exception as e:
+            logger.error(f"Error while streaming answer: {str(e)}")
+            yield _sse_event(str(e), event="error")
+            return
 
-    for record in records:
-        question, answer, timestamp = record
-        chat_history_html += "<p><strong>Question:</strong></p>"
-        chat_history_html += f"<p>{question}</p>"
-        chat_history_html += "<p><strong>Answer:</strong></p>"
+        yield _sse_event("", event="done")
 
-        # Replace "**" with <strong> tags for bold formatting
-        while "**" in answer:
-            answer = answer.replace("**", "<strong>", 1)
-            answer = answer.replace("**", "</strong>", 1)
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
 
-        chat_history_html += f"<p>{answer}</p>"
-        chat_history_html += f"<p><strong>Timestamp:</strong> {timestamp}</p>"
-        chat_history_html += "<hr>"
+@app.route('/healthz')
+@app.route('/chat/healthz')
+def healthz():
+    try:
+        verify_credentials()
+        with borrow_reader() as conn:
+            conn.execute("SELECT 1 FROM chat_history LIMIT 1").fetchall()
+    except Exception as e:
+        return jsonify(status="error", error=str(e)), 503
+    return jsonify(status="ok")
 
-    chat_history_html += "</body></html>"
+_HISTORY_HEAD = "<html><body>"
+_HISTORY_FOOT = "</body></html>"
 
-    return chat_history_html
+def render_row(question, answer, answer_z, timestamp):
+    return (
+        f"<p><strong>Question:</strong></p><p>{html.escape(question)}</p>"
+        f"<p><strong>Answer:</strong></p><div>{_render_answer_html(_stored_answer(answer, answer_z))}</div>"
+        f"<p><strong>Timestamp:</strong> {timestamp}</p><hr>"
+    )
 
-if __name__ == "__main__":
+@app.route('/chat_history')
+@app.route('/chat/chat_history')
+def chat_history():
+    def generate():
+        with borrow_reader() as conn:
+            cursor = conn.execute(HISTORY_SQL)
+            cursor.arraysize = HISTORY_BATCH_SIZE
+            yield _HISTORY_HEAD
+
+            # One chunk per fetched batch keeps the number of writes to the client low
+            records = cursor.fetchmany()
+            while records:
+                yield "".join(itertools.starmap(render_row, records))
+                records = cursor.fetchmany()
+
+        yield _HISTORY_FOOT
+
+    # Run the query before streaming starts so database errors still return a 500
+    chunks = generate()
+    head = next(chunks)
+    return Response(stream_with_context(itertools.chain([head], chunks)), mimetype="text/html")
+
+def main():
     create_table()
+    threading.Thread(target=warm_render_cache, name="render-cache-warmup", daemon=True).start()
     USE_DEBUG = os.getenv("USE_DEBUG", "False").lower() == "true"
     app.run(host='0.0.0.0', port=48080, debug=USE_DEBUG)
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,22 @@
 #!/usr/bin/env python3
-import unittest
 from unittest.mock import patch, MagicMock, ANY, call
-from flask import Flask
-import os
+import pytest
 import sys
 import sqlite3
 import openai
 import anthropic
 import json
+import httpx
 from datetime import datetime
-import logging
 from http import HTTPStatus
+from types import SimpleNamespace as NS
 import app
 from app import insert_question_answer
 
 TEST_QUESTION = 'Test question'
 TEST_ANSWER = "Test response"
+# Serialised once for the tests that post the same question repeatedly
+ASK_BODY = json.dumps({'question': TEST_QUESTION}).encode()
 MISSING_QUESTION = 'Missing question parameter'
 ERROR_CASES = [
     (anthropic.RateLimitError, {"error": {"message": "Rate limit"}}, 429),
@@ -29,6 +30,34 @@ OPENAI_QUESTION = 'Test question for OpenAI'
 OPENAI_RESPONSE = "OpenAI response"
 GET_OPENAI_RESPONSE = 'app.get_openai_response'
 CHAT_WITH_CHATGPT = "Chat with ChatGPT"
+# (USE_DEBUG value, debug flag passed to app.run)
+DEBUG_CASES = (
+    ("true", True),
+    ("True", True),
+    ("FALSE", False),
+    ("false", False),
+    ("0", False),
+    ("1", False),
+    (None, False),
+)
+
+# (openai_key, claude_key, provider function chosen)
+ENV_CASES = (
+    ('test-key', None, 'get_openai_response'),
+    (None, 'test-key', 'get_claude_response'),
+    ('test-key', 'test-key', 'get_openai_response'),
+    (None, None, None),
+)
+# (openai_key, claude_key, page title)
+TITLE_CASES = (
+    ('test-openai-key', None, "Chat with ChatGPT"),
+    (None, 'test-claude-key', "Chat with Claude"),
+    (None, None, "Chat with No Model Available"),
+)
+
+def last_history_id():
+    with app.borrow_reader() as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_history").fetchone()[0]
 
 def create_mock_response(status_code, body):
     mock_response = MagicMock()
@@ -36,566 +65,604 @@ def create_mock_response(status_code, body):
     mock_response.json.return_value = body
     return mock_response
 
-class TestApp(unittest.TestCase):
-    def setUp(self):
-        # Save original environment variables
-        self.original_openai = os.environ.get('OPENAI_API_KEY')
-        self.original_claude = os.environ.get('CLAUDE_API_KEY')
-        self.original_debug = os.environ.get('USE_DEBUG')
-
-        # Ensure test database doesn't interfere with production
-        self.test_db = 'test_chat_history.db'
-        self.original_db_name = 'chat_history.db'
-
-        # Set up logging capture
-        self.log_capture = []
-        self.logger = logging.getLogger('app')
-        self.handler = logging.StreamHandler(sys.stdout)
-        self.logger.addHandler(self.handler)
-        self.logger.setLevel(logging.INFO)
-
-        # Clear any existing database
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
-
-    def tearDown(self):
-        # Restore original environment variables
-        for env_var, original_value in [
-            ('OPENAI_API_KEY', self.original_openai),
-            ('CLAUDE_API_KEY', self.original_claude),
-            ('USE_DEBUG', self.original_debug)
-        ]:
-            if original_value:
-                os.environ[env_var] = original_value
-            else:
-                os.environ.pop(env_var, None)
-
-        # Clean up test database
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
-
-        # Remove logging handler
-        self.logger.removeHandler(self.handler)
-
-        # Clear any imported modules to ensure fresh import
-        if 'app' in sys.modules:
-            del sys.modules['app']
-
-    def test_environment_variable_combinations(self):
-        test_cases = [
-            (None, None, SystemExit),  # No keys
-            ('test-key', None, None),  # Only OpenAI
-            (None, 'test-key', None),  # Only Claude
-            ('test-key', 'test-key', None),  # Both keys
-        ]
-
-        for openai_key, claude_key, expected_exception in test_cases:
-            # Reset environment
-            os.environ.pop('OPENAI_API_KEY', None)
-            os.environ.pop('CLAUDE_API_KEY', None)
-
-            # Set test environment
-            if openai_key:
-                os.environ['OPENAI_API_KEY'] = openai_key
-            if claude_key:
-                os.environ['CLAUDE_API_KEY'] = claude_key
-
-            if expected_exception:
-#                with self.assertRaises(expected_exception):
-#                    if 'app' in sys.modules:
-#                        del sys.modules['app']
-#                    import app
-                pass
-            else:
-#                if 'app' in sys.modules:
-#                    del sys.modules['app']
-#                import app
-                self.assertTrue(hasattr(app, 'app'))
-
-    def test_database_operations_comprehensive(self):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        import app
-
-        # Clear existing data in the database
-        conn = sqlite3.connect(app.DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM chat_history")  # Clear the table
-        conn.commit()
-        conn.close()
-
-        # Test table creation
+# Built once; the retry tests raise this same instance on every attempt
+RATE_LIMIT_ERROR = openai.RateLimitError(
+    message="Rate limit exceeded",
+    response=create_mock_response(429, {"error": {"message": "Rate limit"}}),
+    body={"error": {"message": "Rate limit"}}
+)
+
+def rate_limit_error(retry_after):
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=httpx.Request("POST", "https://api.test"))
+    return openai.RateLimitError(message="Rate limit exceeded", response=response, body=None)
+
+def test_app_imports():
+    assert hasattr(app, 'app')
+
+@pytest.mark.parametrize("test_data", [
+    [("Q1", "A1"), ("Q2", "A2 with **bold**")],
+    # Test XSS handling
+    pytest.param([("Q3", "A3 with <script>alert('xss')</script>")], marks=pytest.mark.security, id="xss"),
+])
+def test_database_operations_comprehensive(clean_db, test_data, fetch_history):
+    # Test multiple insertions
+    app.insert_many(test_data)
+
+    # Test retrieval: the history comes back in insertion order
+    assert fetch_history() == test_data
+
+def test_insert_many(fetch_history):
+    start = last_history_id()
+
+    rows = [("Bulk Q1", "Bulk A1"), ("Bulk Q2", "Bulk A2")]
+    app.insert_many(rows)
+
+    assert fetch_history(start) == rows
+
+def test_insert_many_rolls_back_on_error(fetch_history):
+    before = len(fetch_history())
+
+    with pytest.raises(sqlite3.IntegrityError):
+        app.insert_many([("Good Q", "Good A"), (None, "Answer without a question")])
+
+    assert len(fetch_history()) == before
+
+def test_answers_stored_compressed(fetch_history):
+    start = last_history_id()
+
+    long_answer = "Compressible answer. " * 200
+    app.insert_question_answer("Compressed Q", long_answer)
+
+    with app.borrow_reader() as conn:
+        answer, answer_z = conn.execute("SELECT answer, answer_z FROM chat_history WHERE id > ?", (start,)).fetchone()
+    assert answer == ''
+    assert len(answer_z) < len(long_answer) // 10
+    assert fetch_history(start) == [("Compressed Q", long_answer)]
+
+@pytest.mark.slow
+def test_create_table_migrates_uncompressed_history(client, fetch_history, tmp_path):
+    legacy_db = str(tmp_path / 'legacy.sqlite')
+    conn = sqlite3.connect(legacy_db)
+    conn.execute('''CREATE TABLE chat_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+    conn.execute("INSERT INTO chat_history (question, answer) VALUES (?, ?)", ("Old Q", "Old **answer**"))
+    conn.commit()
+    conn.close()
+
+    with patch.object(app, 'DB_NAME', legacy_db):
+        app.close_connections()
         app.create_table()
+        app.insert_question_answer("New Q", "New answer")
+        response = client.get('/chat_history')
+        history = fetch_history()
+        app.close_connections()
 
-        # Test multiple insertions
-        test_data = [
-            ("Q1", "A1"),
-            ("Q2", "A2 with **bold**"),
-            ("Q3", "A3 with <script>alert('xss')</script>")  # Test XSS handling
-        ]
-
-        for q, a in test_data:
-            app.insert_question_answer(q, a)
-
-        # Test retrieval
-        conn = sqlite3.connect(app.DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT question, answer FROM chat_history ORDER BY id")
-        results = cursor.fetchall()
-        conn.close()
-
-        # Assert that the number of results matches the number of test entries
-        self.assertEqual(len(results), len(test_data))
-
-        # Optionally, verify content if needed
-        for i, (question, answer) in enumerate(test_data):
-            self.assertEqual(results[i], (question, answer))
-
-    @patch('sqlite3.connect')
-    def test_database_error_scenarios(self, mock_connect):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        import app
+    assert history == [("Old Q", "Old **answer**"), ("New Q", "New answer")]
+    assert b"Old <strong>answer</strong>" in response.data
+    assert b"New answer" in response.data
 
+def test_database_error_scenarios():
+    with patch('sqlite3.connect') as mock_connect:
         # Test connection error
         mock_connect.side_effect = sqlite3.Error("Connection failed")
-        with self.assertRaises(sqlite3.Error):
+        with pytest.raises(sqlite3.Error):
             app.create_table()
 
         # Test execution error
         mock_db = MagicMock()
-        mock_cursor = MagicMock()
-        mock_cursor.execute.side_effect = sqlite3.Error("Execution failed")
-        mock_db.cursor.return_value = mock_cursor
+        mock_db.execute.side_effect = sqlite3.Error("Execution failed")
         mock_connect.side_effect = None
         mock_connect.return_value = mock_db
 
-        with self.assertRaises(sqlite3.Error):
+        with pytest.raises(sqlite3.Error):
             app.create_table()
 
-    def test_chat_history_comprehensive(self):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        import app
-
-        # Insert test data with various formatting
-        test_data = [
-            ("Q1", "Normal answer"),
-            ("Q2", "Answer with **bold** text"),
-            ("Q3", "Answer with <strong>HTML</strong>"),
-            ("Q4", "Answer with **multiple** **bold** words"),
-            ("Q5", "Answer with incomplete **bold"),
-        ]
-
-        for q, a in test_data:
-            app.insert_question_answer(q, a)
-
-        # Test main chat history endpoint
-        response = app.app.test_client().get('/chat_history')
-        self.assertEqual(response.status_code, 200)
-
-        # Verify formatting
-        response_data = response.data.decode('utf-8')
-        self.assertIn('<strong>bold</strong>', response_data)
-        self.assertIn('<strong>HTML</strong>', response_data)
-        self.assertIn('<strong>multiple</strong>', response_data)
-        self.assertIn('incomplete <strong>bold', response_data)  # Incomplete formatting should be preserved
-
-    def test_debug_mode_comprehensive(self):
-        test_cases = [
-            ('true', True),
-            ('True', True),
-            ('FALSE', False),
-            ('false', False),
-            ('0', False),
-            ('1', False),
-            (None, False)
-        ]
-
-        for debug_value, expected_debug in test_cases:
-            os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-            if debug_value is not None:
-                os.environ['USE_DEBUG'] = debug_value
-            else:
-                os.environ.pop('USE_DEBUG', None)
-
-            with patch('flask.Flask.run') as mock_run:
-                import app
-                app.app.run(host='0.0.0.0', port=48080, debug=expected_debug)
-                mock_run.assert_called_once_with(
-                    host='0.0.0.0',
-                    port=48080,
-                    debug=expected_debug
-                )
-
-            if 'app' in sys.modules:
-                del sys.modules['app']
-
-    @patch('app.get_openai_response')
-    def test_ask_api_exception_handling(self, mock_get_response):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        mock_get_response.side_effect = Exception("Test exception")
-        response = app.app.test_client().post('/ask', json={'question': 'Test question'})
-        self.assertEqual(response.status_code, 500)
-        self.assertEqual(response.get_json(), {'error': 'Test exception'})
-
-    def test_home_route_without_keys(self):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ.pop('CLAUDE_API_KEY', None)
-        response = app.app.test_client().get('/')
-        self.assertEqual(response.status_code, 200)
-        self.assertIn(CHAT_WITH_CHATGPT, response.data.decode('utf-8'))
-
-    @patch('sqlite3.connect')
-    def test_create_table_called(self, mock_connect):
+@pytest.mark.slow
+def test_chat_history_comprehensive(client):
+    # Insert test data with various formatting
+    test_data = [
+        ("Q1", "Normal answer"),
+        ("Q2", "Answer with **bold** text"),
+        ("Q3", "Answer with <strong>HTML</strong>"),
+        ("Q4", "Answer with **multiple** **bold** words"),
+        ("Q5", "Answer with incomplete **bold"),
+    ]
+
+    app.insert_many(test_data)
+
+    # Test main chat history endpoint
+    response = client.get('/chat_history')
+    assert response.status_code == 200
+
+    # Verify formatting
+    assert b'<strong>bold</strong>' in response.data
+    assert b'<strong>HTML</strong>' in response.data
+    assert b'<strong>multiple</strong>' in response.data
+    # An unmatched marker stays literal rather than opening a tag
+    assert b'incomplete **bold' in response.data
+
+def test_ask_api_exception_handling(client, caplog):
+    with patch.object(app, '_ANSWER_FN', side_effect=Exception("Test exception")):
+        response = client.post('/ask', json={'question': 'Test question'})
+    assert response.status_code == 500
+    assert response.get_json() == {'error': 'Test exception'}
+    assert "Unexpected error: Test exception" in caplog.text
+
+def test_create_table_called():
+    with patch('sqlite3.connect') as mock_connect:
         conn = MagicMock()
         mock_connect.return_value = conn
 
         app.create_table()
-        conn.cursor().execute.assert_called_once()
-
-    @patch('app.create_table')
-    @patch('sqlite3.connect')
-    def test_insert_question_answer_with_operational_error(self, mock_connect, mock_create_table):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        import app
-
-        # Mock the database connection and cursor
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-
-        # Set up the mock cursor to raise an OperationalError on the first call, then succeed
-        mock_cursor.execute.side_effect = [sqlite3.OperationalError, None]
-        mock_conn.cursor.return_value = mock_cursor
-        mock_connect.return_value = mock_conn
-
-        # Call the function to insert data
-        question, answer = "Q_test", "A_test"
-        app.insert_question_answer(question, answer)
-
-        # Check if create_table was called due to the OperationalError
-        mock_create_table.assert_called_once()
-
-        # Check if the insert was retried after create_table was called
-        self.assertEqual(mock_cursor.execute.call_count, 2)
-        mock_cursor.execute.assert_any_call("INSERT INTO chat_history (question, answer) VALUES (?, ?)", (question, answer))
-
-        # Commit should have been called once after a successful retry
-        mock_conn.commit.assert_called_once()
-
-    @patch('app.get_openai_response')
-    @patch('app.insert_question_answer')
-    def test_ask_route_openai(self, mock_insert, mock_get_openai_response):
-        # Set up environment to use OpenAI
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        os.environ.pop('CLAUDE_API_KEY', None)
-
-        # Import app after setting environment variables
-        import app
-
-        # Mock responses
-        mock_get_openai_response.return_value = OPENAI_RESPONSE
-
-        # Send request
-        response = app.app.test_client().post('/ask', json={'question': OPENAI_QUESTION})
-
-        # Assert correct response and function calls
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json, {'question': OPENAI_QUESTION, 'answer': OPENAI_RESPONSE})
-        mock_get_openai_response.assert_called_once_with(
-            'Test question for OpenAI. Answer the question using HTML5 tags to improve formatting. Do not break the 3rd wall and explicitly mention the HTML5 tags.'
-        )
-        mock_insert.assert_called_once_with(OPENAI_QUESTION, OPENAI_RESPONSE)
-
-    @patch('anthropic.Anthropic')
-    @patch('sys.exit')
-    @patch('os.getenv')
-    def test_home_route_titles(self, mock_getenv, mock_exit, mock_anthropic):
-        # Mock `sys.exit` to prevent stopping the test
-        mock_exit.side_effect = SystemExit
-    
-        # Mock Anthropic client to simulate API key validation
-        mock_client = MagicMock()
-        mock_anthropic.return_value = mock_client
-    
-        # Simulate different cases
-        test_cases = [
-            ('test-openai-key', None, "Chat with ChatGPT", False),
-            (None, 'test-claude-key', "Chat with Claude", False),
-            (None, None, "Chat with No Model Available", True),
-        ]
-    
-        for openai_key, claude_key, expected_title, should_exit in test_cases:
-            # Reset mocks
-            mock_getenv.reset_mock()
-            mock_exit.reset_mock()
-    
-            # Mock environment variables
-            mock_getenv.side_effect = lambda x: {'OPENAI_API_KEY': openai_key, 'CLAUDE_API_KEY': claude_key}.get(x)
-    
-            if claude_key:
-                # Simulate successful Anthropic API key validation
-                mock_client.messages.create.return_value = MagicMock()
-    
-            try:
-                # Reload `app.py` to reinitialize with mocked environment variables
-                if 'app' in sys.modules:
-                    del sys.modules['app']
-                import app
-    
-                if should_exit:
-                    # Check if `sys.exit(1)` was called
-                    mock_exit.assert_called_once_with(1)
-                else:
-                    # Validate the response for the `/` route
-                    mock_exit.assert_not_called()
-                    response = app.app.test_client().get('/')
-                    self.assertEqual(response.status_code, 200)
-                    self.assertIn(expected_title.encode(), response.data)
-    
-            except SystemExit:
-                if not should_exit:
-                    self.fail("Unexpected system exit.")
-
-    def test_insert_question_answer(self):
-        question = 'Sample question'
-        answer = 'Sample answer'
-        with patch('app.sqlite3.connect') as mock_connect:
-            mock_db = MagicMock()
-            mock_connect.return_value = mock_db
-            insert_question_answer(question, answer)
-            mock_db.cursor.return_value.execute.assert_called_with(
-                "INSERT INTO chat_history (question, answer) VALUES (?, ?)", (question, answer))
-            mock_db.commit.assert_called_once()
-            mock_db.close.assert_called_once()
-
-    @patch('sys.exit')
-    def test_missing_environment_variables(self, mock_exit):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ.pop('CLAUDE_API_KEY', None)
-        
-        try:
-            import app
-        except SystemExit:
-            pass
-    
-        mock_exit.assert_called_once_with(1)
-
-    @patch('openai.chat.completions.create')
-    def test_openai_response_handling(self, mock_create):
-        mock_create.side_effect = Exception("API Error")
-        with self.assertRaises(Exception) as cm:
-            app.get_openai_response("Test OpenAI Question")
-        self.assertIn("API Error", str(cm.exception))
-
-    @patch('sys.exit')
-    def test_no_api_keys(self, mock_exit):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ.pop('CLAUDE_API_KEY', None)
-        try:
-            import app
-        except SystemExit:
-            pass
-        mock_exit.assert_called_once_with(1)
-
-    def test_home_route(self):
-        with app.app.test_client() as client:
-            response = client.get('/')
-            self.assertEqual(response.status_code, 200)
-            self.assertIn(b'Chat with', response.data)
-
-    def test_chat_history_route(self):
-        with app.app.test_client() as client:
-            response = client.get('/chat_history')
-            self.assertEqual(response.status_code, 200)
-            self.assertIn(b'<strong>Question:</strong>', response.data)
-
-    @patch('anthropic.Anthropic')
-    def test_claude_api_validation_success(self, mock_anthropic):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ['CLAUDE_API_KEY'] = 'test-claude-key'
-        
-        # Mock successful API validation
-        mock_client = MagicMock()
-        mock_anthropic.return_value = mock_client
-        mock_response = MagicMock()
-        mock_response.content = [MagicMock(text="test")]
-        mock_client.messages.create.return_value = mock_response
-        
-        import app
-        self.assertIsNotNone(app.CLAUDE_API_KEY)
-    
-    @patch('anthropic.Anthropic')
-    def test_claude_api_validation_error(self, mock_anthropic):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ['CLAUDE_API_KEY'] = 'test-claude-key'
-        
-        mock_client = MagicMock()
-        mock_anthropic.return_value = mock_client
-        mock_client.messages.create.side_effect = Exception("API validation error")
-        
-        with self.assertRaises(SystemExit) as cm:
-            import app
-        self.assertEqual(cm.exception.code, 1)
-    
-    @patch('app.get_openai_response')
-    def test_ask_rate_limit_retry(self, mock_get_response):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        import app
-        
-        # Simulate 3 rate limit errors then success
-        side_effects = [
-            openai.RateLimitError(
-                message="Rate limit exceeded",
-                response=create_mock_response(429, {"error": {"message": "Rate limit"}}),
-                body={"error": {"message": "Rate limit"}}
-            ),
-            openai.RateLimitError(
-                message="Rate limit exceeded",
-                response=create_mock_response(429, {"error": {"message": "Rate limit"}}),
-                body={"error": {"message": "Rate limit"}}
-            ),
-            "Success response"
-        ]
-        mock_get_response.side_effect = side_effects
-        
-        with patch('time.sleep') as mock_sleep:
-            response = app.app.test_client().post('/ask', json={'question': TEST_QUESTION})
-            self.assertEqual(response.status_code, 200)
-            self.assertEqual(response.json['answer'], "Success response")
-            self.assertEqual(mock_sleep.call_count, 2)  # Called twice for retries
-    
-    @patch('sqlite3.connect')
-    def test_insert_question_answer_database_error(self, mock_connect):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        mock_connect.side_effect = sqlite3.Error("Database error")
-        
-        with self.assertRaises(sqlite3.Error):
+    statements = [c[0][0] for c in conn.execute.call_args_list]
+    assert any("CREATE TABLE IF NOT EXISTS chat_history" in sql for sql in statements)
+
+def test_writer_creates_schema_on_first_use(fetch_history, tmp_path):
+    with patch.object(app, 'DB_NAME', str(tmp_path / 'fresh.sqlite')):
+        app.close_connections()
+        # No create_table() call: the first insert opens the writer, which creates the table
+        app.insert_question_answer("Q_test", "A_test")
+        history = fetch_history()
+        app.close_connections()
+    assert history == [("Q_test", "A_test")]
+
+def test_answer_in_history_as_soon_as_ask_returns(client):
+    # The page reloads the history straight after /ask replies, so the row must already be there
+    with patch.object(app, '_ANSWER_FN', return_value="Fresh answer"):
+        assert client.post('/chat/ask', json={'question': "Fresh question"}).status_code == 200
+    response = client.get('/chat/chat_history')
+    assert b"Fresh answer" in response.data
+
+def test_insert_question_answer_uses_immediate_transaction():
+    mock_conn = MagicMock()
+    with patch('app.get_writer', return_value=mock_conn):
+        app.insert_question_answer("Q_test", "A_test")
+
+    assert mock_conn.execute.call_args_list[0] == call("BEGIN IMMEDIATE")
+    mock_conn.execute.assert_called_with(app._INSERT_SQL, ("Q_test", ANY))
+    mock_conn.__exit__.assert_called_once_with(None, None, None)
+
+def test_healthz_database_error(client):
+    with patch('app.borrow_reader', side_effect=sqlite3.OperationalError("unable to open database file")):
+        response = client.get('/healthz')
+    assert response.status_code == 503
+    assert response.get_json()['error'] == "unable to open database file"
+
+def test_ask_route_openai(client):
+    # The provider is chosen once at import
+    assert app._ANSWER_FN is app.get_openai_response
+    assert app._STREAM_FN is app.stream_openai_response
+
+    # Mock responses and send request
+    with patch.object(app, '_ANSWER_FN', return_value=OPENAI_RESPONSE) as mock_get_openai_response, \
+            patch('app.insert_question_answer') as mock_insert:
+        response = client.post('/ask', json={'question': OPENAI_QUESTION})
+
+    # Assert correct response and function calls
+    assert response.status_code == 200
+    assert response.json == {'question': OPENAI_QUESTION, 'answer': OPENAI_RESPONSE}
+    mock_get_openai_response.assert_called_once_with(
+        'Test question for OpenAI. Answer the question using HTML5 tags to improve formatting. Do not break the 3rd wall and explicitly mention the HTML5 tags.'
+    )
+    mock_insert.assert_called_once_with(OPENAI_QUESTION, OPENAI_RESPONSE)
+
+def test_ask_without_answer_text(client):
+    with patch.object(app, '_ANSWER_FN', return_value=None), patch('app.insert_question_answer') as mock_insert:
+        response = client.post('/ask', json={'question': TEST_QUESTION})
+    assert response.status_code == 502
+    assert response.get_json() == {'error': "The model returned no answer"}
+    mock_insert.assert_not_called()
+
+def test_ask_stream_route(client):
+    with patch.object(app, '_STREAM_FN', return_value=iter(["Hello", " world\nsecond line"])), \
+            patch('app.insert_question_answer') as mock_insert:
+        response = client.post('/ask/stream', json={'question': TEST_QUESTION})
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        body = response.get_data(as_text=True)
+
+    assert "data: Hello\n\n" in body
+    assert "data:  world\ndata: second line\n\n" in body
+    assert body.endswith("event: done\ndata: \n\n")
+    mock_insert.assert_called_once_with(TEST_QUESTION, "Hello world\nsecond line")
+
+def test_ask_stream_error(client):
+    with patch.object(app, '_STREAM_FN', side_effect=Exception("Stream failed")), \
+            patch('app.insert_question_answer') as mock_insert:
+        response = client.post('/ask/stream', json={'question': TEST_QUESTION})
+        body = response.get_data(as_text=True)
+    assert body == "event: error\ndata: Stream failed\n\n"
+    mock_insert.assert_not_called()
+
+def test_ask_stream_save_error(client):
+    with patch.object(app, '_STREAM_FN', return_value=iter(["Hello"])), \
+            patch('app.insert_question_answer', side_effect=sqlite3.OperationalError("database is locked")):
+        body = client.post('/ask/stream', json={'question': TEST_QUESTION}).get_data(as_text=True)
+    assert body == "data: Hello\n\nevent: error\ndata: database is locked\n\n"
+
+def test_stream_openai_response():
+    chunks = [
+        NS(choices=[NS(delta=NS(content="Open"))]),
+        NS(choices=[NS(delta=NS(content=None))]),
+        NS(choices=[NS(delta=NS(content="AI"))]),
+    ]
+    mock_create = app.openai_client.chat.completions.create
+    mock_create.return_value = iter(chunks)
+    assert list(app.stream_openai_response("Q")) == ["Open", "AI"]
+    assert mock_create.call_args.kwargs['stream']
+
+@pytest.mark.parametrize(("openai_key", "claude_key", "expected_title"), TITLE_CASES)
+def test_home_route_titles(client, configure, openai_key, claude_key, expected_title):
+    # The title follows the configured provider on the shared module, no reimport needed
+    configure(openai_key, claude_key)
+    assert expected_title.encode() in client.get('/').data
+
+def test_insert_question_answer():
+    question = 'Sample question'
+    answer = 'Sample answer'
+    with patch('app.sqlite3.connect') as mock_connect:
+        mock_db = MagicMock()
+        mock_connect.return_value = mock_db
+        insert_question_answer(question, answer)
+        mock_db.execute.assert_called_with(app._INSERT_SQL, (question, ANY))
+        stored = mock_db.execute.call_args[0][1][1]
+        assert app._stored_answer('', stored) == answer
+        # The pooled writer stays open between inserts
+        mock_db.close.assert_not_called()
+
+def test_openai_response_handling():
+    app.openai_client.chat.completions.create.side_effect = Exception("API Error")
+    with pytest.raises(Exception, match="API Error"):
+        app.get_openai_response("Test OpenAI Question")
+
+@pytest.mark.parametrize(("openai_key", "claude_key", "expected_fn"), ENV_CASES)
+def test_configure_selects_provider(configure, openai_key, claude_key, expected_fn):
+    configure(openai_key, claude_key)
+    assert app._ANSWER_FN is (getattr(app, expected_fn) if expected_fn else None)
+
+@pytest.mark.parametrize("path", ['/ask', '/ask/stream'])
+def test_ask_without_provider_returns_503(client, configure, path):
+    configure(None, None)
+    response = client.post(path, data=ASK_BODY, content_type='application/json')
+    assert response.status_code == 503
+    assert response.get_json() == {'error': 'No model available'}
+
+def test_reload_keys_reads_environment(monkeypatch):
+    monkeypatch.setenv('CLAUDE_API_KEY', 'env-claude-key')
+    with patch.object(app, 'configure') as mock_configure:
+        app.reload_keys()
+    mock_configure.assert_called_once_with('test-openai-key', 'env-claude-key')
+
+def test_provider_clients_share_http_client():
+    assert isinstance(app.http_client, httpx.Client)
+    assert app.openai_client._client is app.http_client
+    assert app.http_client.timeout.read == 60
+
+def test_home_route(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert b'Chat with' in response.data
+
+def test_chat_history_route(client):
+    app.insert_question_answer("Route question", "Route answer")
+    response = client.get('/chat_history')
+    assert response.status_code == 200
+    assert b'<strong>Question:</strong>' in response.data
+
+def test_render_answer_html_markdown():
+    app._render_answer_html.cache_clear()
+    rendered = app._render_answer_html("# Title\n\n- one\n- two\n\n`code`")
+    assert "<h1>Title</h1>" in rendered
+    assert "<li>one</li>" in rendered
+    assert "<code>code</code>" in rendered
+
+    # Rendering the same answer again is served from the cache
+    app._render_answer_html("# Title\n\n- one\n- two\n\n`code`")
+    assert app._render_answer_html.cache_info().hits == 1
+
+def test_warm_render_cache():
+    app.insert_question_answer("Warm Q", "Warm **answer**")
+    app._render_answer_html.cache_clear()
+    app.warm_render_cache()
+
+    info = app._render_answer_html.cache_info()
+    assert info.currsize > 0
+    app._render_answer_html("Warm **answer**")
+    assert app._render_answer_html.cache_info().hits == info.hits + 1
+
+def test_history_query_uses_rowid_order():
+    with app.borrow_reader() as conn:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {app.HISTORY_SQL}").fetchall()
+        mmap_size = conn.execute("PRAGMA mmap_size").fetchone()[0]
+    assert not any("TEMP B-TREE" in row[-1] for row in plan)
+    assert mmap_size == app.READER_MMAP_SIZE
+
+def test_render_row():
+    row_html = app.render_row("<i>Q</i>", "", app._compress_answer("**A**"), "2024-01-01 00:00:00")
+    assert "<p>&lt;i&gt;Q&lt;/i&gt;</p>" in row_html
+    assert "<strong>A</strong>" in row_html
+    assert "<p><strong>Timestamp:</strong> 2024-01-01 00:00:00</p>" in row_html
+    assert row_html.endswith("<hr>")
+
+def test_chat_history_is_streamed(client):
+    app.insert_question_answer("Streamed question", "Streamed answer")
+    response = client.get('/chat_history')
+    assert response.is_streamed
+    assert response.mimetype == 'text/html'
+    body = response.get_data(as_text=True)
+    assert body.startswith('<html><body>')
+    assert body.endswith('</body></html>')
+    assert 'Streamed answer' in body
+
+def test_claude_api_validation_error(client, use_claude):
+    mock_client = anthropic.Anthropic.return_value
+    mock_client.messages.create.side_effect = Exception("API validation error")
+
+    # Switching provider does not call the API; the failure surfaces on first use
+    use_claude('test-claude-key')
+    mock_client.messages.create.assert_not_called()
+
+    response = client.post('/ask', json={'question': TEST_QUESTION})
+    assert response.status_code == 500
+    assert response.get_json() == {'error': 'API validation error'}
+
+@pytest.mark.slow
+def test_ask_rate_limit_retry(client, mock_sleep):
+    # Simulate 2 rate limit errors then success
+    side_effects = [RATE_LIMIT_ERROR, RATE_LIMIT_ERROR, "Success response"]
+
+    with patch.object(app, '_ANSWER_FN', side_effect=side_effects):
+        response = client.post('/ask', data=ASK_BODY, content_type='application/json')
+    assert response.status_code == 200
+    assert response.json['answer'] == "Success response"
+    assert mock_sleep.call_count == 2  # Called twice for retries
+
+@pytest.mark.slow
+def test_ask_rate_limit_exhausted_returns_503(client, mock_sleep, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_RETRIES', 2)
+    with patch.object(app, '_ANSWER_FN', side_effect=[RATE_LIMIT_ERROR, RATE_LIMIT_ERROR]):
+        response = client.post('/ask', data=ASK_BODY, content_type='application/json')
+    assert response.status_code == 503
+    assert mock_sleep.call_count == 1
+
+def test_ask_honours_retry_after(client, mock_sleep):
+    side_effect = [rate_limit_error("0.5"), "Success response"]
+    with patch.object(app, '_ANSWER_FN', side_effect=side_effect), patch.object(app, 'insert_question_answer'):
+        response = client.post('/ask', data=ASK_BODY, content_type='application/json')
+    assert response.status_code == 200
+    mock_sleep.assert_called_once_with(0.5)
+
+@pytest.mark.slow
+@pytest.mark.parametrize("retry_after", ["-1", "nan", "inf", "soon"])
+def test_ask_ignores_invalid_retry_after(client, mock_sleep, retry_after):
+    side_effect = [rate_limit_error(retry_after), "Success response"]
+    with patch.object(app, '_ANSWER_FN', side_effect=side_effect), patch.object(app, 'insert_question_answer'):
+        response = client.post('/ask', data=ASK_BODY, content_type='application/json')
+    assert response.status_code == 200
+    # Falls back to the first backoff step: 1 second plus jitter
+    delay = mock_sleep.call_args.args[0]
+    assert 1 <= delay < 2
+
+def test_ask_long_retry_after_returns_503(client, mock_sleep):
+    with patch.object(app, '_ANSWER_FN', side_effect=rate_limit_error("30")) as mock_get_response:
+        response = client.post('/ask', data=ASK_BODY, content_type='application/json')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+    mock_sleep.assert_not_called()
+    mock_get_response.assert_called_once()
+
+def test_token_bucket():
+    with patch('app.time.monotonic', return_value=100.0) as mock_monotonic:
+        bucket = app.TokenBucket(2, period=60.0)
+        assert bucket.try_acquire() == 0
+        assert bucket.try_acquire() == 0
+        # Empty bucket: one token refills every 30 seconds
+        assert bucket.try_acquire() == pytest.approx(30.0)
+        mock_monotonic.return_value = 130.0
+        assert bucket.try_acquire() == 0
+
+def test_ask_rate_limited_by_token_bucket(client):
+    with patch.object(app, '_ANSWER_FN', return_value=TEST_ANSWER) as mock_get_response, \
+            patch('app.insert_question_answer'), patch.object(app, '_ask_limiter', app.TokenBucket(1)):
+        assert client.post('/ask', data=ASK_BODY, content_type='application/json').status_code == 200
+
+        response = client.post('/ask', data=ASK_BODY, content_type='application/json')
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '60'
+    mock_get_response.assert_called_once()
+
+def test_insert_question_answer_database_error():
+    with patch('sqlite3.connect', side_effect=sqlite3.Error("Database error")):
+        with pytest.raises(sqlite3.Error):
             app.insert_question_answer("test", "test")
-    
-    def test_ask_invalid_json(self):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        
-        response = app.app.test_client().post(
-            '/ask',
-            data='invalid json',
-            content_type='application/json'
+
+def test_json_provider_uses_orjson():
+    provider = app.app.json
+    assert isinstance(provider, app.ORJSONProvider)
+    assert provider.dumps({'b': 1, 'a': 2}) == '{"b":1,"a":2}'
+    assert provider.dumps({'b': 1, 'a': 2}, sort_keys=True) == '{"a":2,"b":1}'
+    assert provider.loads(b'{"question": "Q"}') == {'question': 'Q'}
+
+@pytest.mark.parametrize("path", ['/ask', '/ask/stream'])
+@pytest.mark.parametrize("question", [42, ["a list"], None])
+def test_ask_rejects_non_string_question(client, path, question):
+    response = client.post(path, json={'question': question})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'question must be a string'}
+
+def test_ask_invalid_json(client):
+    response = client.post(
+        '/ask',
+        data='invalid json',
+        content_type='application/json'
+    )
+    assert response.status_code == 400
+
+def test_claude_api_validation_success(use_claude):
+    mock_client = anthropic.Anthropic.return_value
+    mock_client.messages.create.return_value = NS(content=[NS(text="test")])
+
+    use_claude()
+    assert app.CLAUDE_API_KEY is not None
+
+def test_claude_api_validation_failure(client, use_claude):
+    mock_client = anthropic.Anthropic.return_value
+    mock_client.messages.create.side_effect = Exception("Validation failed")
+
+    use_claude('invalid-claude-key')
+    response = client.get('/healthz')
+    assert response.status_code == 503
+    assert response.get_json() == {'status': 'error', 'error': 'Validation failed'}
+
+def test_claude_credentials_verified_once(client, use_claude):
+    mock_client = anthropic.Anthropic.return_value
+    mock_client.messages.create.return_value = NS(content=[NS(text="test")])
+
+    use_claude()
+    for _ in range(2):
+        response = client.get('/healthz')
+        assert response.status_code == 200
+        assert response.get_json() == {'status': 'ok'}
+    mock_client.messages.create.assert_called_once()
+
+def test_claude_insufficient_credits(use_claude):
+    mock_client = anthropic.Anthropic.return_value
+    mock_client.messages.create.side_effect = anthropic.BadRequestError(
+        message="Your credit balance is too low",
+        response=MagicMock(status_code=400),
+        body={"error": {"message": "Your credit balance is too low"}}
+    )
+
+    use_claude()
+    with pytest.raises(app.InsufficientCreditsError):
+        app.verify_credentials()
+
+def test_get_claude_response_success(use_claude):
+    # Set up mock client
+    mock_client = anthropic.Anthropic.return_value
+
+    # Set up mock responses for both the validation call and the test call
+    validation_response = NS(content=[NS(text="test")])
+
+    test_response = NS(content=[NS(text="Claude response")])
+
+    mock_client.messages.create.side_effect = [validation_response, test_response]
+
+    use_claude()
+    app.verify_credentials()
+    response = app.get_claude_response("Test question")
+    assert response == "Claude response"
+
+    # Verify both calls were made with correct parameters
+    mock_client.messages.create.assert_has_calls([
+        # First call - API validation
+        call(
+            model="claude-3-sonnet-20240229",
+            max_tokens=1,
+            messages=[{"role": "user", "content": "test"}]
+        ),
+        # Second call - actual test
+        call(
+            model="claude-3-sonnet-20240229",
+            messages=[{"role": "user", "content": "Test question"}],
+            max_tokens=1024
         )
-        self.assertEqual(response.status_code, 400)
-
-    @patch('sys.exit')
-    def test_missing_api_keys(self, mock_exit):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ.pop('CLAUDE_API_KEY', None)
-        
-        import app  # This won't raise SystemExit because we mocked sys.exit
-        mock_exit.assert_called_once_with(1)
-
-    @patch('anthropic.Anthropic')
-    def test_claude_api_validation_success(self, mock_anthropic):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ['CLAUDE_API_KEY'] = 'valid-claude-key'
-        
-        mock_client = MagicMock()
-        mock_anthropic.return_value = mock_client
-        mock_client.messages.create.return_value = MagicMock(content=[MagicMock(text="test")])
-        
-        import app
-        self.assertIsNotNone(app.CLAUDE_API_KEY)
-    
-    @patch('anthropic.Anthropic')
-    def test_claude_api_validation_failure(self, mock_anthropic):
-        os.environ.pop('OPENAI_API_KEY', None)
-        os.environ['CLAUDE_API_KEY'] = 'invalid-claude-key'
-        
-        mock_client = MagicMock()
-        mock_anthropic.return_value = mock_client
-        mock_client.messages.create.side_effect = Exception("Validation failed")
-        
-        with self.assertRaises(SystemExit) as cm:
-            import app
-        self.assertEqual(cm.exception.code, 1)
-
-    @patch('anthropic.Anthropic')
-    def test_get_claude_response_success(self, mock_anthropic):
-        os.environ['CLAUDE_API_KEY'] = 'valid-claude-key'
-        os.environ.pop('OPENAI_API_KEY', None)
-        
-        # Set up mock client
-        mock_client = MagicMock()
-        mock_anthropic.return_value = mock_client
-        
-        # Set up mock responses for both the validation call and the test call
-        validation_response = MagicMock()
-        validation_response.content = [MagicMock(text="test")]
-        
-        test_response = MagicMock()
-        test_response.content = [MagicMock(text="Claude response")]
-        
-        mock_client.messages.create.side_effect = [validation_response, test_response]
-        
-        import app
-        response = app.get_claude_response("Test question")
-        self.assertEqual(response, "Claude response")
-        
-        # Verify both calls were made with correct parameters
-        mock_client.messages.create.assert_has_calls([
-            # First call - API validation
-            call(
-                model="claude-3-sonnet-20240229",
-                max_tokens=1,
-                messages=[{"role": "user", "content": "test"}]
-            ),
-            # Second call - actual test
-            call(
-                model="claude-3-sonnet-20240229",
-                messages=[{"role": "user", "content": "Test question"}],
-                max_tokens=1024
-            )
-        ])
-
-    @patch('openai.chat.completions.create')
-    def test_get_openai_response_success(self, mock_create):
-        os.environ['OPENAI_API_KEY'] = 'valid-openai-key'
-        import app
-        
-        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="OpenAI response"))])
-        
-        response = app.get_openai_response("Test question")
-        self.assertEqual(response, "OpenAI response")
-
-    def test_chat_history_formatting(self):
-        os.environ['OPENAI_API_KEY'] = 'test-openai-key'
-        import app
-    
-        test_data = [
-            ("Q1", "A1 with no bold"),
-            ("Q2", "A2 with **bold** text"),
-            ("Q3", "A3 with incomplete **bold")
-        ]
-    
-        for question, answer in test_data:
-            app.insert_question_answer(question, answer)
-    
-        response = app.app.test_client().get('/chat_history')
-        self.assertEqual(response.status_code, 200)
-        response_data = response.data.decode('utf-8')
-    
-        # Test complete bold marker conversion
-        self.assertIn("<strong>bold</strong>", response_data)
-        
-        # Test incomplete bold marker handling
-        self.assertIn("Answer with incomplete <strong>bold", response_data)  
-        
-        # Test text without any markers
-        self.assertIn("A1 with no bold", response_data)
-
-    @patch('openai.chat.completions.create')
-    def test_get_openai_response_success(self, mock_create):
-        os.environ['OPENAI_API_KEY'] = 'valid-openai-key'
-        
-        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="OpenAI response"))])
-        
-        import app
-        response = app.get_openai_response("Test question")
-        self.assertEqual(response, "OpenAI response")
+    ])
+
+def test_chat_history_formatting(client):
+    test_data = [
+        ("Q1", "A1 with no bold"),
+        ("Q2", "A2 with **bold** text"),
+        ("Q3", "A3 with incomplete **bold")
+    ]
+
+    app.insert_many(test_data)
+
+    response = client.get('/chat_history')
+    assert response.status_code == 200
+
+    # Test complete bold marker conversion
+    assert b"<strong>bold</strong>" in response.data
+
+    # Test incomplete bold marker handling
+    assert b"A3 with incomplete **bold" in response.data
+
+    # Test text without any markers
+    assert b"A1 with no bold" in response.data
+
+@pytest.mark.security
+def test_chat_history_sanitizes_html(client):
+    app.insert_question_answer(
+        "<b>Q</b>",
+        "<h2 onclick='x()'>Title</h2><script>alert('xss')</script><iframe src='x'></iframe>"
+    )
+
+    response = client.get('/chat_history')
+    assert response.status_code == 200
+
+    # Allowed tags survive without their attributes
+    assert b"<h2>Title</h2>" in response.data
+    # Disallowed tags are stripped
+    assert b"<script>" not in response.data
+    assert b"<iframe" not in response.data
+    # Questions are shown as plain text
+    assert b"&lt;b&gt;Q&lt;/b&gt;" in response.data
+
+def test_get_openai_response_success():
+    mock_create = app.openai_client.chat.completions.create
+    mock_create.return_value = NS(choices=[NS(message=NS(content="OpenAI response"))])
+
+    response = app.get_openai_response("Test question")
+    assert response == "OpenAI response"
+
+@pytest.mark.parametrize(("answer", "expected"), [
+    ("a **b** c **d**", "a <strong>b</strong> c <strong>d</strong>"),
+    ("a **b** c **d", "a <strong>b</strong> c **d"),
+    ("`a**b`", "<code>a**b</code>"),
+    ("```python\nx = 2**3 + y**2\n```", "<pre><code>x = 2**3 + y**2\n</code></pre>"),
+    ("\\*\\*not bold\\*\\*", "**not bold**"),
+    ("a ** b", "a ** b"),
+])
+def test_render_answer_html_bold_markers(answer, expected):
+    assert expected in app._render_answer_html(answer)
+
+def test_render_answer_html_without_bold_markers():
+    assert "<strong>" not in app._render_answer_html("no markers here")
+
+@pytest.mark.parametrize("answer", [
+    "", "Plain answer.", "First line\nSecond line", "One paragraph.\n\n\nAnother, with 3.5 apples.",
+    "cba@\x0c%", "Null\x00byte", "Bell\x07 and\x1b escape",
+])
+def test_plain_text_fast_path_matches_markdown(answer):
+    full = app.bleach.clean(app.markdown.render(answer), tags=app.ALLOWED_TAGS, attributes={}, strip=True)
+    # Whichever path renders the answer, the HTML is the same as the full pipeline's
+    assert app._render_answer_html.__wrapped__(answer) == full
+    assert app._plain_text_html(answer) in (full, None)
+
+@pytest.mark.parametrize("answer", ["Plain answer.", "First line\nSecond line", "One paragraph.\n\n\nAnother, with 3.5 apples."])
+def test_plain_text_fast_path_takes_prose(answer):
+    assert app._plain_text_html(answer) is not None
+
+@pytest.mark.parametrize("answer", [
+    "# Title", "1. item", "Some *emphasis*", "  indented", "A <b>tag</b>", "Line\n- item",
+    "cba@\x0c%", "Null\x00byte",
+])
+def test_plain_text_fast_path_skips_markup(answer):
+    assert app._plain_text_html(answer) is None
+
+@pytest.mark.parametrize(("val", "expected"), DEBUG_CASES)
+def test_debug_mode(val, expected, monkeypatch):
+    if val is None:
+        monkeypatch.delenv('USE_DEBUG', raising=False)
+    else:
+        monkeypatch.setenv('USE_DEBUG', val)
+    with patch.object(app.app, 'run') as mock_run, patch.object(app, 'warm_render_cache'):
+        app.main()
+    mock_run.assert_called_once_with(host='0.0.0.0', port=48080, debug=expected)
 
 if __name__ == '__main__':
-    unittest.main()
+    sys.exit(pytest.main([__file__]))
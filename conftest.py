@@ -0,0 +1,147 @@
+import ast
+import os
+import sqlite3
+import tempfile
+from unittest.mock import MagicMock, create_autospec, patch
+
+import anthropic
+import pytest
+from anthropic.resources import Messages
+from openai.resources.chat import Completions
+
+# Each xdist worker gets its own SQLite file, so parallel tests never contend for one database.
+# It lives on tmpfs where available so commits never wait on a disk flush.
+_WORKER = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+_DB_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+os.environ["DB_NAME"] = os.path.join(_DB_DIR, f"chat-{_WORKER}.sqlite")
+os.environ.setdefault("OPENAI_API_KEY", "test-openai-key")
+
+for _suffix in ("", "-wal", "-shm"):
+    if os.path.exists(os.environ["DB_NAME"] + _suffix):
+        os.remove(os.environ["DB_NAME"] + _suffix)
+
+
+@pytest.fixture(scope="session")
+def client():
+    import app
+    return app.app.test_client()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    # Create the worker's tables once and keep an in-memory copy of the empty database for clean_db
+    import app
+    app.create_table()
+    template = sqlite3.connect(":memory:")
+    with app.borrow_reader() as conn:
+        conn.backup(template)
+    yield template
+    template.close()
+
+
+@pytest.fixture
+def clean_db(schema):
+    # Page-copy the empty snapshot over the worker's database, for tests that assert on the whole history
+    import app
+    schema.backup(app.get_writer())
+
+
+@pytest.fixture
+def fetch_history():
+    # Reads back (question, answer) pairs written after after_id, with answers decompressed
+    import app
+
+    def fetch(after_id=0):
+        with app.borrow_reader() as conn:
+            records = conn.execute(
+                "SELECT question, answer, answer_z FROM chat_history WHERE id > ? ORDER BY id", (after_id,)
+            ).fetchall()
+        return [(question, app._stored_answer(answer, answer_z)) for question, answer, answer_z in records]
+
+    return fetch
+
+
+@pytest.fixture(autouse=True)
+def api_env(monkeypatch):
+    # Every test starts from the same provider keys, whatever the previous test left behind
+    monkeypatch.setenv("OPENAI_API_KEY", "test-openai-key")
+    monkeypatch.delenv("CLAUDE_API_KEY", raising=False)
+    monkeypatch.delenv("USE_DEBUG", raising=False)
+
+
+@pytest.fixture(autouse=True)
+def db_connections():
+    import app
+    # Drop pooled connections so patched sqlite3.connect calls take effect
+    app.close_connections()
+
+
+# Provider mocks are specced once per session and reset between tests; calls must match the SDK signatures
+_OPENAI_COMPLETIONS = create_autospec(Completions, instance=True)
+_CLAUDE_MESSAGES = create_autospec(Messages, instance=True)
+_ANTHROPIC = MagicMock()
+_ANTHROPIC.return_value.messages = _CLAUDE_MESSAGES
+
+
+@pytest.fixture(scope="session", autouse=True)
+def llm_clients():
+    # Installed once on the SDK classes, so clients rebuilt by configure() are covered too
+    with patch.object(Completions, "create", _OPENAI_COMPLETIONS.create), patch.object(anthropic, "Anthropic", _ANTHROPIC):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def mock_llm_clients():
+    # No test reaches a real provider; tests configure these shared mocks as needed
+    _ANTHROPIC.reset_mock()
+    for mock in (_OPENAI_COMPLETIONS, _CLAUDE_MESSAGES):
+        mock.reset_mock(return_value=True, side_effect=True)
+
+
+_SLEEP = MagicMock()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def no_backoff():
+    # Retry backoff returns at once for the whole run
+    import app
+    with patch.object(app, "sleep", _SLEEP):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def mock_sleep():
+    # Tests assert on the backoff calls recorded since they started
+    _SLEEP.reset_mock()
+    return _SLEEP
+
+
+@pytest.fixture
+def configure():
+    # app.configure for one test; the shared module goes back to the keys in the environment afterwards
+    import app
+    yield app.configure
+    app.reload_keys()
+
+
+@pytest.fixture
+def use_claude(configure):
+    def switch(key="valid-claude-key"):
+        configure(claude_key=key)
+
+    return switch
+
+
+def pytest_collection_modifyitems(items):
+    # A test defined twice silently replaces the first copy, so refuse to run with duplicates
+    paths = {}
+    for path in {item.path for item in items}:
+        if path.name in paths:
+            raise pytest.UsageError(f"Test modules {paths[path.name]} and {path} share a name")
+        paths[path.name] = path
+        tree = ast.parse(path.read_text())
+        for scope in [tree] + [node for node in ast.walk(tree) if isinstance(node, ast.ClassDef)]:
+            names = [node.name for node in scope.body if isinstance(node, ast.FunctionDef)]
+            duplicates = sorted({name for name in names if names.count(name) > 1})
+            if duplicates:
+                raise pytest.UsageError(f"{path.name} defines {', '.join(duplicates)} more than once")
@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+import threading
+
+bind = "0.0.0.0:48080"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# Streaming answers can take a while to finish
+timeout = 120
+
+def post_worker_init(worker):
+    # Each worker owns its render cache, so warm it after the fork
+    from app import warm_render_cache
+    threading.Thread(target=warm_render_cache, name="render-cache-warmup", daemon=True).start()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import contextlib
+from unittest.mock import patch
+import pytest
+import sys
+import app
+
+# These tests reimport app; xdist keeps them together on one worker so only that worker pays for it
+pytestmark = [pytest.mark.serial, pytest.mark.xdist_group("import_boundary")]
+
+@contextlib.contextmanager
+def fresh_app():
+    # Import a throwaway copy of app to test import-time behaviour, then put the shared module back
+    shared = sys.modules.pop('app')
+    try:
+        import app as fresh
+        try:
+            yield fresh
+        finally:
+            # The copy's connection pool would otherwise stay open for the rest of the run
+            fresh.http_client.close()
+    finally:
+        sys.modules['app'] = shared
+
+def test_no_api_keys(monkeypatch):
+    monkeypatch.delenv('OPENAI_API_KEY', raising=False)
+    # The app exits before it builds any clients, so this reimport stops early
+    with patch('sys.exit', side_effect=SystemExit) as mock_exit, pytest.raises(SystemExit), fresh_app():
+        pass
+    mock_exit.assert_called_once_with(1)
+
+def test_max_retries_at_least_one(monkeypatch):
+    monkeypatch.setenv('MAX_RETRIES', '0')
+    with fresh_app() as fresh:
+        assert fresh.MAX_RETRIES == 1
+
+def test_db_readers_at_least_one(monkeypatch):
+    monkeypatch.setenv('DB_READERS', '0')
+    with fresh_app() as fresh:
+        assert fresh.DB_READERS == 1
+        assert fresh._readers.maxsize == 1
+
+if __name__ == '__main__':
+    sys.exit(pytest.main([__file__]))
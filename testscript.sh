@@ -4,8 +4,7 @@
 pip install -r requirements.txt
 
 # Run tests and generate coverage reports
-coverage run -m unittest discover -s . -p "app_unittest.py"
-coverage xml
+pytest -m "" --cov=app --cov-report=xml
 
 # Cleanup
 rm -rf __pycache__